@@ -1,6 +1,7 @@
 import asyncio
 
 from fastapi import FastAPI, Depends
+from starlette.middleware.gzip import GZipMiddleware
 from contextlib import asynccontextmanager
 
 from api.inference.manager import InferenceManager
@@ -67,6 +68,9 @@ async def lifespan(app: FastAPI):
 
 app = FastAPI(lifespan=lifespan)
 
+# Added first so ProxyMiddleware stays outermost and streamed /v1 responses
+# bypass compression.
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=1)
 app.add_middleware(ProxyMiddleware)
 
 app.include_router(
@@ -9,7 +9,7 @@ from abc import ABC, abstractmethod
 
 from common.logger import create_logger
 from common.trackable_task import ITrackableTask
-from api.proxy import setup_vllm_proxy
+from api.proxy import setup_vllm_proxy, any_vllm_healthy
 
 
 TERMINATION_TIMEOUT = 20
@@ -162,6 +162,13 @@ class VLLMRunner(IVLLMRunner):
     def is_running(self) -> bool:
         return len(self.processes) > 0 and all(p.poll() is None for p in self.processes)
 
+    def is_alive(self) -> bool:
+        # The proxy already probes every backend's /health; only fall back to
+        # probing here when it has no healthy backend on record.
+        if not self.is_running():
+            return False
+        return any_vllm_healthy() or self.is_available()
+
     def is_available(self) -> bool:
         if not self.is_running():
             return False
@@ -1,12 +1,13 @@
 import asyncio
 import os
+import time
 from typing import Dict, List, Optional
 
 import httpx
-from fastapi import FastAPI, Request, Response
-from fastapi.responses import StreamingResponse
+from fastapi import Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 from starlette.background import BackgroundTask
-from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.types import ASGIApp, Receive, Scope, Send
 
 from common.logger import create_logger
 
@@ -15,157 +16,244 @@ logger = create_logger(__name__)
 VLLM_HOST = "127.0.0.1"
 
 LIMITS = httpx.Limits(
-    max_connections=20_000,
-    max_keepalive_connections=5_000,
+    max_connections=int(os.getenv("VLLM_PROXY_MAX_CONNECTIONS", 20_000)),
+    max_keepalive_connections=int(os.getenv("VLLM_PROXY_MAX_KEEPALIVE_CONNECTIONS", 5_000)),
+    keepalive_expiry=float(os.getenv("VLLM_PROXY_KEEPALIVE_EXPIRY", 5.0)),
 )
 
+TIMEOUT = httpx.Timeout(
+    connect=float(os.getenv("VLLM_PROXY_CONNECT_TIMEOUT", 5.0)),
+    read=float(os.getenv("VLLM_PROXY_READ_TIMEOUT", 900.0)),
+    write=None,
+    pool=float(os.getenv("VLLM_PROXY_POOL_TIMEOUT", 5.0)),
+)
+
+# Header names are matched against ASGI/httpx raw headers, hence bytes.
+STRIP_REQUEST_HEADERS = frozenset({b"host"})
+STRIP_RESPONSE_HEADERS = frozenset({b"content-length", b"transfer-encoding", b"connection"})
+
+COMPATIBILITY_METHODS = frozenset({"GET", "POST", "PUT", "DELETE", "PATCH", "OPTIONS"})
+
+# Request bodies up to this size are read up front and sent in one write.
+MAX_BUFFERED_BODY = 64 * 1024
+
+# Non-SSE upstream bodies are re-chunked to this size; SSE is passed through
+# as received so tokens flush promptly.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Upper bound for the probe backoff of a backend that went down.
+HEALTH_CHECK_MAX_BACKOFF = 30.0
+
 vllm_backend_ports: List[int] = []
 vllm_healthy: Dict[int, bool] = {}
+vllm_live: List[int] = []
 vllm_counts: Dict[int, int] = {}
-vllm_pick_lock = asyncio.Lock()
+vllm_base_urls: Dict[int, str] = {}
+vllm_failures: Dict[int, int] = {}
+vllm_next_probe: Dict[int, float] = {}
 vllm_client: Optional[httpx.AsyncClient] = None
 
-compatibility_app: Optional[FastAPI] = None
 compatibility_server_task: Optional[asyncio.Task] = None
 
 
-class ProxyMiddleware(BaseHTTPMiddleware):
-    """Middleware to handle routing between /api and /v1 endpoints."""
-    
-    async def dispatch(self, request: Request, call_next):
-        path = request.url.path
-        
-        if path.startswith("/v1"):
-            return await self._proxy_to_vllm(request)
-        
-        if path.startswith("/api"):
-            return await call_next(request)
-        
-        return await call_next(request)
+class ProxyMiddleware:
+    """ASGI middleware to handle routing between /api and /v1 endpoints."""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not scope["path"].startswith("/v1"):
+            await self.app(scope, receive, send)
+            return
+
+        response = await self._proxy_to_vllm(Request(scope, receive))
+        await response(scope, receive, send)
     
     async def _proxy_to_vllm(self, request: Request) -> Response:
         """Proxy requests to vLLM backend with load balancing."""
-        return await _proxy_request_to_backend(request, request.url.path)
+        return await _proxy_request_to_backend(request)
+
 
+async def _proxy_request_to_backend(request: Request) -> Response:
+    """Common proxy logic for routing requests to vLLM backends.
 
-async def _proxy_request_to_backend(request: Request, backend_path: str) -> Response:
-    """Common proxy logic for routing requests to vLLM backends."""
+    Shared by the /v1 middleware and the backward compatibility server; both
+    forward the request path unchanged.
+    """
     if not vllm_backend_ports:
         return Response(status_code=503, content=b"No vLLM backend available")
     
-    if not any(vllm_healthy.values()):
+    if not vllm_live:
         return Response(status_code=503, content=b"vLLM backend not ready")
     
+    if vllm_client is None:
+        return Response(status_code=503, content=b"vLLM client not initialized")
+
     try:
-        port = await _pick_vllm_backend()
+        port = _pick_vllm_backend()
     except RuntimeError:
         return Response(status_code=503, content=b"No vLLM backend available")
 
-    async def iter_body():
-        async for chunk in request.stream():
-            yield chunk
-
-    if not backend_path.startswith("/"):
-        backend_path = "/" + backend_path
-    url = f"http://{VLLM_HOST}:{port}{backend_path}"
-    headers = {k: v for k, v in request.headers.items() if k.lower() != "host"}
-
-    if vllm_client is None:
-        return Response(status_code=503, content=b"vLLM client not initialized")
+    url = vllm_base_urls[port] + request.scope["path"]
+    query = request.scope["query_string"]
+    if query:
+        url += "?" + query.decode("latin-1")
+    headers = [(k, v) for k, v in request.headers.raw if k not in STRIP_REQUEST_HEADERS]
 
     try:
         cm = vllm_client.stream(
             request.method,
             url,
-            params=request.query_params,
             headers=headers,
-            content=iter_body(),
-            timeout=httpx.Timeout(None, read=900),
+            content=await _request_content(request),
         )
 
         upstream = await cm.__aenter__()
 
-        resp_headers = {
-            k: v
-            for k, v in upstream.headers.items()
-            if k.lower() not in {"content-length", "transfer-encoding", "connection"}
-        }
+        resp_headers = [
+            (name, v)
+            for k, v in upstream.headers.raw
+            if (name := k.lower()) not in STRIP_RESPONSE_HEADERS
+        ]
 
-        async def _cleanup(cxt, port_):
-            try:
-                await cxt.__aexit__(None, None, None)
-            finally:
-                await _release_vllm_backend(port_)
-
-        return StreamingResponse(
-            upstream.aiter_raw(),
+        event_stream = upstream.headers.get("content-type", "").startswith("text/event-stream")
+        response = StreamingResponse(
+            upstream.aiter_raw(None if event_stream else STREAM_CHUNK_SIZE),
             status_code=upstream.status_code,
-            headers=resp_headers,
-            background=BackgroundTask(_cleanup, cm, port),
+            background=BackgroundTask(_close_upstream, cm, port),
         )
+        response.raw_headers = resp_headers
+        return response
 
     except Exception as exc:
         logger.exception("vLLM proxy error: %s", exc)
-        await _release_vllm_backend(port)
+        _release_vllm_backend(port)
         return Response(status_code=502, content=b"vLLM upstream failure")
 
 
-async def _pick_vllm_backend() -> int:
-    """Least-connections picker for vLLM backends."""
-    async with vllm_pick_lock:
-        live = [p for p, ok in vllm_healthy.items() if ok]
-        if not live:
-            raise RuntimeError("no vLLM backend")
-        port = min(live, key=lambda p: vllm_counts.get(p, 0))
-        vllm_counts[port] += 1
-        return port
+async def _close_upstream(cm, port: int):
+    """Close the upstream stream and release its backend once a response is sent."""
+    try:
+        await cm.__aexit__(None, None, None)
+    finally:
+        _release_vllm_backend(port)
+
 
+async def _request_content(request: Request):
+    """Return the body to forward: None, buffered bytes, or a stream.
 
-async def _release_vllm_backend(port: int):
-    """Release a vLLM backend connection."""
-    async with vllm_pick_lock:
-        vllm_counts[port] -= 1
+    The choice follows the request framing rather than the method, so the
+    body always matches the content-length/transfer-encoding we forward.
+    """
+    if "transfer-encoding" not in request.headers:
+        content_length = request.headers.get("content-length")
+        if content_length is None or content_length == "0":
+            return None
+        if content_length.isdigit() and int(content_length) <= MAX_BUFFERED_BODY:
+            return await request.body()
+    return request.stream()
+
+
+def _pick_vllm_backend() -> int:
+    """Least-connections picker for vLLM backends.
+
+    Runs without awaiting, so it is atomic on the event loop and needs no lock.
+    Only scans `vllm_live`, which the health check keeps up to date.
+    """
+    if not vllm_live:
+        raise RuntimeError("no vLLM backend")
+    port = min(vllm_live, key=vllm_counts.__getitem__)
+    vllm_counts[port] += 1
+    return port
+
+
+def _release_vllm_backend(port: int):
+    """Release a vLLM backend connection.
+
+    Tolerates ports whose counters were reset by setup_vllm_proxy while the
+    request was in flight.
+    """
+    count = vllm_counts.get(port)
+    if count:
+        vllm_counts[port] = count - 1
+
+
+async def _probe_vllm(port: int) -> bool:
+    """Return whether the vLLM backend on the given port answers /health."""
+    try:
+        r = await vllm_client.get(vllm_base_urls[port] + "/health", timeout=2)
+        ok = r.status_code == 200
+        logger.debug("Health check for port %d: status=%d, ok=%s", port, r.status_code, ok)
+        return ok
+    except Exception as e:
+        logger.debug("Health check for port %d failed: %s", port, e)
+        return False
 
 
 async def _health_check_vllm(interval: float = 5.0):
     """Health check for vLLM backends."""
     while True:
-        if not vllm_backend_ports:
+        if not vllm_backend_ports or vllm_client is None:
             # No backends configured yet, wait and check again
             await asyncio.sleep(interval)
             continue
             
         logger.debug("Health check running, backend ports: %s", vllm_backend_ports)
-        for p in vllm_backend_ports:
-            ok = False
-            try:
-                if vllm_client is None:
-                    continue
-                r = await vllm_client.get(f"http://{VLLM_HOST}:{p}/health", timeout=2)
-                ok = r.status_code == 200
-                logger.debug("Health check for port %d: status=%d, ok=%s", p, r.status_code, ok)
-            except Exception as e:
-                logger.debug("Health check for port %d failed: %s", p, e)
-
+        now = time.monotonic()
+        ports = [p for p in vllm_backend_ports if vllm_next_probe.get(p, 0.0) <= now]
+        # Probe all due backends concurrently, then apply the results in one
+        # step so the picker never sees a half-updated pass.
+        results = await asyncio.gather(*(_probe_vllm(p) for p in ports))
+
+        changed = False
+        for p, ok in zip(ports, results):
             prev = vllm_healthy.get(p)
+            vllm_healthy[p] = ok
             if prev != ok:
                 logger.info("%s:%d is %s", VLLM_HOST, p, "UP" if ok else "DOWN")
-            vllm_healthy[p] = ok
+                changed = True
+            if ok:
+                vllm_failures.pop(p, None)
+                vllm_next_probe.pop(p, None)
+            elif prev or p in vllm_failures:
+                # Back off exponentially on a backend that went down; backends
+                # that are still starting up keep the regular interval.
+                failures = vllm_failures[p] = vllm_failures.get(p, 0) + 1
+                delay = min(HEALTH_CHECK_MAX_BACKOFF, interval * 2 ** (failures - 1))
+                vllm_next_probe[p] = now + delay
+        if changed:
+            _refresh_vllm_live()
         logger.debug("Current healthy status: %s", vllm_healthy)
         
-        if compatibility_server_task and not any(vllm_healthy.values()):
+        if compatibility_server_task and not vllm_live:
             logger.info("No vLLM backends healthy, stopping backward compatibility server")
             await stop_backward_compatibility()
         
         await asyncio.sleep(interval)
 
 
+def any_vllm_healthy() -> bool:
+    """Return whether the last health check found any vLLM backend healthy."""
+    return bool(vllm_live)
+
+
+def _refresh_vllm_live():
+    """Rebuild the list of healthy backend ports used by the picker."""
+    global vllm_live
+    vllm_live = [p for p in vllm_backend_ports if vllm_healthy.get(p)]
+
+
 def setup_vllm_proxy(backend_ports: List[int]):
     """Setup vLLM proxy with given backend ports."""
-    global vllm_backend_ports, vllm_counts
+    global vllm_backend_ports, vllm_counts, vllm_base_urls
     vllm_backend_ports = backend_ports
     vllm_counts = {p: 0 for p in vllm_backend_ports}
+    vllm_base_urls = {p: f"http://{VLLM_HOST}:{p}" for p in vllm_backend_ports}
     vllm_healthy.update({p: False for p in vllm_backend_ports})
+    vllm_failures.clear()
+    vllm_next_probe.clear()
+    _refresh_vllm_live()
     logger.info("vLLM proxy setup with %d backends: %s", len(backend_ports), backend_ports)
     logger.debug("vLLM backend ports: %s", vllm_backend_ports)
     logger.debug("vLLM healthy status: %s", vllm_healthy)
@@ -175,7 +263,7 @@ def setup_vllm_proxy(backend_ports: List[int]):
 async def start_vllm_proxy():
     """Start vLLM proxy components."""
     global vllm_client
-    vllm_client = httpx.AsyncClient(http2=True, limits=LIMITS)
+    vllm_client = httpx.AsyncClient(http2=True, limits=LIMITS, timeout=TIMEOUT)
     # Always start health check - it will monitor for new backends
     asyncio.create_task(_health_check_vllm())
     asyncio.create_task(_start_backward_compatibility_when_ready())
@@ -194,7 +282,7 @@ async def stop_vllm_proxy():
 async def _start_backward_compatibility_when_ready():
     """Start backward compatibility server when vLLM backends are ready."""
     while True:
-        if any(vllm_healthy.values()):
+        if vllm_live:
             logger.info("vLLM backends are ready, starting backward compatibility server")
             await start_backward_compatibility()
             break
@@ -203,21 +291,27 @@ async def _start_backward_compatibility_when_ready():
 
 
 
-async def _compatibility_proxy_handler(request: Request, path: str):
-    """Handler for backward compatibility server - proxies all requests to vLLM backends."""
-    return await _proxy_request_to_backend(request, path)
+async def compatibility_app(scope: Scope, receive: Receive, send: Send):
+    """ASGI app for the backward compatibility server.
+
+    Proxies every request straight to vLLM without a router in between.
+    """
+    if scope["type"] != "http":
+        return
+
+    if scope["method"] in COMPATIBILITY_METHODS:
+        response = await _proxy_request_to_backend(Request(scope, receive))
+    else:
+        response = JSONResponse(
+            {"detail": "Method Not Allowed"},
+            status_code=405,
+            headers={"Allow": ", ".join(sorted(COMPATIBILITY_METHODS))},
+        )
+    await response(scope, receive, send)
 
 
 async def _run_compatibility_server():
     """Run the backward compatibility server on port 5000."""
-    global compatibility_app
-    
-    compatibility_app = FastAPI(title="vLLM Backward Compatibility Proxy")
-    
-    @compatibility_app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH", "OPTIONS"])
-    async def proxy_all(request: Request, path: str):
-        return await _compatibility_proxy_handler(request, path)
-    
     import uvicorn
     
     logger.info("Starting backward compatibility server on port 5000")
@@ -227,6 +321,7 @@ async def _run_compatibility_server():
         port=5000,
         workers=1,
         timeout_keep_alive=300,
+        lifespan="off",
         log_level="info"
     )
     server = uvicorn.Server(config)
@@ -245,7 +340,7 @@ async def start_backward_compatibility():
 
 async def stop_backward_compatibility():
     """Stop backward compatibility server."""
-    global compatibility_server_task, compatibility_app
+    global compatibility_server_task
     if compatibility_server_task:
         compatibility_server_task.cancel()
         try:
@@ -253,5 +348,4 @@ async def stop_backward_compatibility():
         except asyncio.CancelledError:
             pass
         compatibility_server_task = None
-        compatibility_app = None
         logger.info("Backward compatibility server stopped") 
\ No newline at end of file
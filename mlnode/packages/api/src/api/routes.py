@@ -1,4 +1,5 @@
-from fastapi import APIRouter, Request
+import orjson
+from fastapi import APIRouter, Request, Response
 from pydantic import BaseModel
 
 from api.service_management import (
@@ -19,11 +20,14 @@ router = APIRouter(
 class StateResponse(BaseModel):
     state: ServiceState
 
-@router.get("/state")
-async def state(request: Request) -> StateResponse:
+# The state payload only depends on ServiceState, so encode each one once.
+STATE_RESPONSE_BODIES = {s: orjson.dumps({"state": s}) for s in ServiceState}
+
+@router.get("/state", response_model=StateResponse)
+async def state(request: Request):
     update_service_state(request)
     state: ServiceState = request.app.state.service_state
-    return StateResponse(state=state)
+    return Response(STATE_RESPONSE_BODIES[state], media_type="application/json")
 
 @router.post("/stop")
 async def stop(request: Request):
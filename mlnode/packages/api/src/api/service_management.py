@@ -10,16 +10,15 @@ class ServiceState(str, Enum):
     STOPPED = "STOPPED"
 
 def get_service_name(request: Request):
-    path = request.url.path
-    return path.removeprefix(API_PREFIX).lstrip("/").split("/")[0].upper()
+    path = request.scope["path"]
+    return path.removeprefix(API_PREFIX).lstrip("/").partition("/")[0].upper()
 
 def update_service_state(request: Request):
     pow_running = request.app.state.pow_manager.is_running()
     inference_running = request.app.state.inference_manager.is_running()
     train_running = request.app.state.train_manager.is_running()
 
-    running_services = sum([pow_running, inference_running, train_running])
-    if running_services > 1:
+    if pow_running + inference_running + train_running > 1:
         request.app.state.pow_manager.stop()
         request.app.state.inference_manager.stop()
         request.app.state.train_manager.stop()
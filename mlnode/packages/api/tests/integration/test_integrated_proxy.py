@@ -1,6 +1,7 @@
 import pytest
 import asyncio
 import requests
+import httpx
 from unittest.mock import patch, MagicMock
 from fastapi.testclient import TestClient
 
@@ -28,14 +29,16 @@ def test_v1_endpoints_proxy_when_no_backend(client):
 
 @patch('api.proxy.vllm_backend_ports', [5001, 5002])
 @patch('api.proxy.vllm_healthy', {5001: True, 5002: True})
+@patch('api.proxy.vllm_live', [5001, 5002])
 @patch('api.proxy.vllm_counts', {5001: 0, 5002: 0})
+@patch('api.proxy.vllm_base_urls', {5001: 'http://127.0.0.1:5001', 5002: 'http://127.0.0.1:5002'})
 def test_v1_endpoints_proxy_with_backend(client):
     """Test that /v1 endpoints are properly routed when backends are available."""
     # Mock the httpx client to simulate backend response
     with patch('api.proxy.vllm_client') as mock_client:
         mock_response = MagicMock()
         mock_response.status_code = 200
-        mock_response.headers = {"content-type": "application/json"}
+        mock_response.headers = httpx.Headers({"content-type": "application/json"})
         mock_response.aiter_raw.return_value = iter([b'{"models": []}'])
         
         mock_stream = MagicMock()
@@ -57,6 +60,8 @@ def test_proxy_middleware_order():
             break
     
     assert middleware_found, "ProxyMiddleware should be in the middleware stack"
+    # Outermost, so /v1 responses never pass through GZipMiddleware
+    assert "ProxyMiddleware" in str(app.user_middleware[0].cls)
 
 
 @pytest.mark.asyncio
@@ -1,15 +1,32 @@
 import pytest
 import asyncio
 from unittest.mock import AsyncMock, MagicMock, patch
+
+import httpx
 from fastapi import Request
 
+from fastapi.testclient import TestClient
+
 from api.proxy import (
+    compatibility_app,
     start_backward_compatibility, 
     stop_backward_compatibility,
-    _compatibility_proxy_handler
+    _proxy_request_to_backend
 )
 
 
+def make_request(path: str = "/v1/models", method: str = "GET") -> Request:
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "headers": [],
+    }
+    return Request(scope, AsyncMock())
+
+
 @pytest.mark.asyncio
 async def test_backward_compatibility_start_stop():
     """Test that backward compatibility server can start and stop."""
@@ -22,24 +39,18 @@ async def test_backward_compatibility_start_stop():
 
 
 @pytest.mark.asyncio
-async def test_compatibility_proxy_handler_no_backends():
-    """Test compatibility proxy handler when no backends are available."""
+async def test_compatibility_proxy_no_backends():
+    """Test compatibility proxying when no backends are available."""
     from api.proxy import vllm_backend_ports
     
-    # Mock request
-    mock_request = MagicMock(spec=Request)
-    mock_request.url.path = "/v1/models"
-    mock_request.method = "GET"
-    mock_request.headers = {}
-    mock_request.query_params = {}
-    mock_request.stream.return_value = []
+    mock_request = make_request()
     
     # Clear backends
     original_backends = vllm_backend_ports.copy()
     vllm_backend_ports.clear()
     
     try:
-        response = await _compatibility_proxy_handler(mock_request, "v1/models")
+        response = await _proxy_request_to_backend(mock_request)
         assert response.status_code == 503
         assert b"No vLLM backend available" in response.body
     finally:
@@ -48,17 +59,11 @@ async def test_compatibility_proxy_handler_no_backends():
 
 
 @pytest.mark.asyncio
-async def test_compatibility_proxy_handler_with_backends():
-    """Test compatibility proxy handler when backends are available."""
+async def test_compatibility_proxy_with_backends():
+    """Test compatibility proxying when backends are available."""
     from api.proxy import vllm_backend_ports, vllm_healthy, vllm_counts, vllm_client
     
-    # Mock request
-    mock_request = MagicMock(spec=Request)
-    mock_request.url.path = "/v1/models"
-    mock_request.method = "GET"
-    mock_request.headers = {}
-    mock_request.query_params = {}
-    mock_request.stream.return_value = []
+    mock_request = make_request()
     
     # Setup mock backends
     original_backends = vllm_backend_ports.copy()
@@ -74,16 +79,18 @@ async def test_compatibility_proxy_handler_with_backends():
     # Mock httpx client
     mock_response = MagicMock()
     mock_response.status_code = 200
-    mock_response.headers = {"content-type": "application/json"}
+    mock_response.headers = httpx.Headers({"content-type": "application/json"})
     mock_response.aiter_raw.return_value = iter([b'{"models": []}'])
     
     mock_stream = MagicMock()
     mock_stream.__aenter__.return_value = mock_response
     
-    with patch('api.proxy.vllm_client') as mock_client:
+    with patch('api.proxy.vllm_live', [5001, 5002]), \
+         patch('api.proxy.vllm_base_urls', {5001: "http://127.0.0.1:5001", 5002: "http://127.0.0.1:5002"}), \
+         patch('api.proxy.vllm_client') as mock_client:
         mock_client.stream.return_value = mock_stream
         
-        response = await _compatibility_proxy_handler(mock_request, "v1/models")
+        response = await _proxy_request_to_backend(mock_request)
         assert response.status_code == 200
     
     # Restore original state
@@ -92,4 +99,18 @@ async def test_compatibility_proxy_handler_with_backends():
     vllm_healthy.clear()
     vllm_healthy.update(original_healthy)
     vllm_counts.clear()
-    vllm_counts.update(original_counts) 
\ No newline at end of file
+    vllm_counts.update(original_counts)
+
+
+def test_compatibility_app_proxies_without_router():
+    """Test that the compatibility app proxies any path and rejects other methods."""
+    client = TestClient(compatibility_app)
+
+    with patch('api.proxy.vllm_backend_ports', []):
+        response = client.get("/v1/models")
+        assert response.status_code == 503
+        assert b"No vLLM backend available" in response.content
+
+    response = client.request("TRACE", "/v1/models")
+    assert response.status_code == 405
+    assert "POST" in response.headers["allow"]
@@ -1,84 +1,99 @@
 import pytest
 import asyncio
 from unittest.mock import AsyncMock, MagicMock, patch
-from fastapi import Request
+
+import httpx
+from fastapi import FastAPI
 from fastapi.testclient import TestClient
 
 from api.proxy import ProxyMiddleware, setup_vllm_proxy, start_vllm_proxy, stop_vllm_proxy
 
 
 @pytest.fixture
-def proxy_middleware():
-    # Create a mock app for the BaseHTTPMiddleware constructor
-    mock_app = MagicMock()
+def mock_app():
+    return AsyncMock()
+
+
+@pytest.fixture
+def proxy_middleware(mock_app):
     return ProxyMiddleware(mock_app)
 
 
+def make_scope(path: str, method: str = "GET"):
+    return {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "headers": [],
+    }
+
+
 @pytest.fixture
-def mock_request():
-    request = MagicMock(spec=Request)
-    request.url.path = "/v1/models"
-    request.method = "GET"
-    request.headers = {}
-    request.query_params = {}
-    request.stream.return_value = []
-    return request
+def receive():
+    return AsyncMock(return_value={"type": "http.request", "body": b"", "more_body": False})
+
+
+@pytest.fixture
+def send():
+    return AsyncMock()
 
 
 @pytest.mark.asyncio
-async def test_proxy_middleware_routes_v1_to_vllm(proxy_middleware, mock_request):
+async def test_proxy_middleware_routes_v1_to_vllm(proxy_middleware, mock_app, receive, send):
     """Test that /v1 requests are routed to vLLM backend."""
     
     # Mock the proxy method on the middleware instance
     with patch.object(proxy_middleware, '_proxy_to_vllm') as mock_proxy:
-        mock_proxy.return_value = MagicMock()
-        
-        # Mock call_next
-        call_next = AsyncMock()
+        mock_proxy.return_value = AsyncMock()
         
         # Test /v1 routing
-        mock_request.url.path = "/v1/models"
-        result = await proxy_middleware.dispatch(mock_request, call_next)
+        await proxy_middleware(make_scope("/v1/models"), receive, send)
         
-        # Should call proxy, not call_next
-        mock_proxy.assert_called_once_with(mock_request)
-        call_next.assert_not_called()
+        # Should call proxy, not the wrapped app
+        mock_proxy.assert_called_once()
+        request = mock_proxy.call_args.args[0]
+        assert request.scope["path"] == "/v1/models"
+        mock_app.assert_not_called()
 
 
 @pytest.mark.asyncio
-async def test_proxy_middleware_routes_api_to_main(proxy_middleware, mock_request):
+async def test_proxy_middleware_routes_api_to_main(proxy_middleware, mock_app, receive, send):
     """Test that /api requests are routed to main API."""
     
-    # Mock call_next
-    call_next = AsyncMock()
-    call_next.return_value = MagicMock()
-    
     # Test /api routing
-    mock_request.url.path = "/api/v1/inference"
-    result = await proxy_middleware.dispatch(mock_request, call_next)
+    scope = make_scope("/api/v1/inference")
+    await proxy_middleware(scope, receive, send)
     
-    # Should call call_next, not proxy
-    call_next.assert_called_once_with(mock_request)
+    # Should call the wrapped app, not proxy
+    mock_app.assert_called_once_with(scope, receive, send)
 
 
 @pytest.mark.asyncio
-async def test_proxy_middleware_default_routing(proxy_middleware, mock_request):
+async def test_proxy_middleware_default_routing(proxy_middleware, mock_app, receive, send):
     """Test that other requests default to main API."""
     
-    # Mock call_next
-    call_next = AsyncMock()
-    call_next.return_value = MagicMock()
-    
     # Test default routing
-    mock_request.url.path = "/health"
-    result = await proxy_middleware.dispatch(mock_request, call_next)
+    scope = make_scope("/health")
+    await proxy_middleware(scope, receive, send)
     
-    # Should call call_next
-    call_next.assert_called_once_with(mock_request)
+    # Should call the wrapped app
+    mock_app.assert_called_once_with(scope, receive, send)
 
 
 @pytest.mark.asyncio
-async def test_proxy_returns_503_when_backends_not_healthy(proxy_middleware, mock_request):
+async def test_proxy_middleware_passes_through_non_http(proxy_middleware, mock_app, receive, send):
+    """Test that lifespan and websocket scopes bypass the proxy."""
+    
+    scope = {"type": "lifespan"}
+    await proxy_middleware(scope, receive, send)
+    
+    mock_app.assert_called_once_with(scope, receive, send)
+
+
+@pytest.mark.asyncio
+async def test_proxy_returns_503_when_backends_not_healthy(proxy_middleware, mock_app, receive, send):
     """Test that proxy returns 503 when no backends are healthy."""
     from api.proxy import vllm_backend_ports, vllm_healthy
     
@@ -91,17 +106,15 @@ async def test_proxy_returns_503_when_backends_not_healthy(proxy_middleware, moc
     vllm_healthy.update({5001: False, 5002: False})
     
     try:
-        # Mock call_next
-        call_next = AsyncMock()
-        
         # Test /v1 routing when backends are unhealthy
-        mock_request.url.path = "/v1/models"
-        result = await proxy_middleware.dispatch(mock_request, call_next)
+        await proxy_middleware(make_scope("/v1/models"), receive, send)
         
-        # Should return 503, not call call_next
-        assert result.status_code == 503
-        assert b"vLLM backend not ready" in result.body
-        call_next.assert_not_called()
+        # Should send 503, not call the wrapped app
+        messages = [c.args[0] for c in send.call_args_list]
+        assert messages[0]["type"] == "http.response.start"
+        assert messages[0]["status"] == 503
+        assert b"vLLM backend not ready" in messages[1]["body"]
+        mock_app.assert_not_called()
     finally:
         # Restore original state
         vllm_backend_ports.clear()
@@ -117,9 +130,10 @@ def test_setup_vllm_proxy():
     setup_vllm_proxy(backend_ports)
     
     # Import here to get the updated global state
-    from api.proxy import vllm_backend_ports, vllm_counts, vllm_healthy
+    from api.proxy import vllm_backend_ports, vllm_counts, vllm_healthy, vllm_base_urls
     
     assert vllm_backend_ports == backend_ports
+    assert vllm_base_urls[5001] == "http://127.0.0.1:5001"
     assert all(port in vllm_counts for port in backend_ports)
     assert all(port in vllm_healthy for port in backend_ports)
 
@@ -140,4 +154,283 @@ async def test_start_stop_vllm_proxy():
     
     # Import again to get the updated state
     from api.proxy import vllm_client
-    assert vllm_client is None 
\ No newline at end of file
+    assert vllm_client is None
+
+
+@pytest.mark.asyncio
+async def test_start_vllm_proxy_uses_limits_and_timeout():
+    """Test that the shared client is built from the module-level LIMITS and TIMEOUT."""
+    from api import proxy
+
+    with patch.object(proxy.httpx, "AsyncClient", return_value=AsyncMock()) as client_cls:
+        await start_vllm_proxy()
+        await stop_vllm_proxy()
+
+    client_cls.assert_called_once_with(http2=True, limits=proxy.LIMITS, timeout=proxy.TIMEOUT)
+
+
+def test_proxy_client_settings_from_env(monkeypatch):
+    """Test that LIMITS and TIMEOUT read their VLLM_PROXY_* overrides."""
+    import importlib
+    from api import proxy
+
+    assert proxy.TIMEOUT.pool == 5.0
+
+    monkeypatch.setenv("VLLM_PROXY_MAX_CONNECTIONS", "100")
+    monkeypatch.setenv("VLLM_PROXY_MAX_KEEPALIVE_CONNECTIONS", "10")
+    monkeypatch.setenv("VLLM_PROXY_KEEPALIVE_EXPIRY", "2.5")
+    monkeypatch.setenv("VLLM_PROXY_CONNECT_TIMEOUT", "1.0")
+    monkeypatch.setenv("VLLM_PROXY_READ_TIMEOUT", "60")
+    monkeypatch.setenv("VLLM_PROXY_POOL_TIMEOUT", "0.5")
+    try:
+        importlib.reload(proxy)
+        assert proxy.LIMITS.max_connections == 100
+        assert proxy.LIMITS.max_keepalive_connections == 10
+        assert proxy.LIMITS.keepalive_expiry == 2.5
+        assert proxy.TIMEOUT.connect == 1.0
+        assert proxy.TIMEOUT.read == 60.0
+        assert proxy.TIMEOUT.write is None
+        assert proxy.TIMEOUT.pool == 0.5
+    finally:
+        monkeypatch.undo()
+        importlib.reload(proxy)
+
+
+def test_pick_vllm_backend_least_connections():
+    """Test that the picker chooses the healthy backend with fewest requests."""
+    from api import proxy
+
+    with patch.object(proxy, "vllm_live", [5001, 5002]), \
+         patch.object(proxy, "vllm_counts", {5001: 2, 5002: 1, 5003: 0}):
+        port = proxy._pick_vllm_backend()
+        assert port == 5002
+        assert proxy.vllm_counts[5002] == 2
+
+        proxy._release_vllm_backend(port)
+        assert proxy.vllm_counts[5002] == 1
+
+        # Counters reset or removed mid-request never go negative or raise
+        proxy._release_vllm_backend(5003)
+        proxy._release_vllm_backend(6000)
+        assert proxy.vllm_counts[5003] == 0
+        assert 6000 not in proxy.vllm_counts
+
+
+def test_vllm_live_tracks_health():
+    """Test that only healthy configured backends are eligible for picking."""
+    from api import proxy
+
+    with patch.object(proxy, "vllm_healthy", {}):
+        setup_vllm_proxy([5001, 5002])
+        assert proxy.vllm_live == []
+
+        proxy.vllm_healthy[5002] = True
+        proxy._refresh_vllm_live()
+        assert proxy.vllm_live == [5002]
+
+
+class _FakeUpstream:
+    def __init__(self, status_code=200, headers=None, chunks=(b"{}",)):
+        self.status_code = status_code
+        self.headers = httpx.Headers(headers or {})
+        self._chunks = chunks
+        self.chunk_size = None
+
+    async def aiter_raw(self, chunk_size=None):
+        self.chunk_size = chunk_size
+        for chunk in self._chunks:
+            yield chunk
+
+
+@pytest.fixture
+def fake_vllm():
+    """Patch proxy state with one healthy backend and a recording client."""
+    from api import proxy
+
+    upstream = _FakeUpstream(headers=[
+        ("Content-Type", "application/json"),
+        ("Content-Length", "2"),
+        ("Connection", "keep-alive"),
+        ("Set-Cookie", "a=1"),
+        ("Set-Cookie", "b=2"),
+    ])
+    stream_cm = MagicMock()
+    stream_cm.upstream = upstream
+    stream_cm.__aenter__ = AsyncMock(return_value=upstream)
+    stream_cm.__aexit__ = AsyncMock(return_value=None)
+    client = MagicMock()
+    client.stream.return_value = stream_cm
+
+    with patch.object(proxy, "vllm_backend_ports", [5001]), \
+         patch.object(proxy, "vllm_live", [5001]), \
+         patch.object(proxy, "vllm_counts", {5001: 0}), \
+         patch.object(proxy, "vllm_base_urls", {5001: "http://127.0.0.1:5001"}), \
+         patch.object(proxy, "vllm_client", client):
+        yield client
+
+
+@pytest.fixture
+def proxy_client():
+    inner = FastAPI()
+
+    @inner.get("/api/ping")
+    async def ping():
+        return {"ok": True}
+
+    inner.add_middleware(ProxyMiddleware)
+    return TestClient(inner)
+
+
+def test_gzip_applies_to_api_but_not_proxied_responses(fake_vllm):
+    """Test that with app.py's middleware order only /api responses get compressed."""
+    from starlette.middleware.gzip import GZipMiddleware
+
+    inner = FastAPI()
+
+    @inner.get("/api/big")
+    async def big():
+        return {"data": "x" * 2048}
+
+    inner.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=1)
+    inner.add_middleware(ProxyMiddleware)
+    client = TestClient(inner)
+    fake_vllm.stream.return_value.upstream._chunks = (b"y" * 2048,)
+
+    response = client.get("/api/big", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.json() == {"data": "x" * 2048}
+
+    response = client.get("/v1/models", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in response.headers
+    assert response.content == b"y" * 2048
+
+
+def test_proxy_forwards_headers(fake_vllm, proxy_client):
+    """Test the target URL and that hop-by-hop headers are dropped both ways."""
+    from api import proxy
+
+    response = proxy_client.get("/v1/models?limit=1&q=a%20b", headers={"X-Trace": "abc"})
+
+    assert response.status_code == 200
+    assert response.content == b"{}"
+    assert response.headers["content-type"] == "application/json"
+    assert "connection" not in response.headers
+    assert response.headers.get_list("set-cookie") == ["a=1", "b=2"]
+
+    args, kwargs = fake_vllm.stream.call_args
+    assert args == ("GET", "http://127.0.0.1:5001/v1/models?limit=1&q=a%20b")
+    sent = dict(kwargs["headers"])
+    assert b"host" not in sent
+    assert sent[b"x-trace"] == b"abc"
+    assert proxy.vllm_counts[5001] == 0
+
+
+def test_proxy_streams_request_body(fake_vllm, proxy_client):
+    """Test that bodies are skipped, buffered or streamed depending on size."""
+    from api import proxy
+
+    proxy_client.get("/v1/models")
+    assert fake_vllm.stream.call_args.kwargs["content"] is None
+
+    proxy_client.post("/v1/completions", content=b'{"prompt": "hi"}')
+    assert fake_vllm.stream.call_args.kwargs["content"] == b'{"prompt": "hi"}'
+
+    proxy_client.post("/v1/completions", content=b"x" * (proxy.MAX_BUFFERED_BODY + 1))
+    assert not isinstance(fake_vllm.stream.call_args.kwargs["content"], bytes)
+
+
+def test_proxy_forwards_delete_body(fake_vllm, proxy_client):
+    """Test that a DELETE with a body is forwarded together with its content-length."""
+    response = proxy_client.request("DELETE", "/v1/models/lora", json={"force": True})
+
+    assert response.status_code == 200
+    kwargs = fake_vllm.stream.call_args.kwargs
+    assert kwargs["content"] == b'{"force":true}'
+    assert dict(kwargs["headers"])[b"content-length"] == b"14"
+
+
+@pytest.mark.asyncio
+async def test_health_check_probes_all_backends():
+    """Test that one health check pass updates every backend at once."""
+    from api import proxy
+
+    async def fake_get(url, timeout):
+        return MagicMock(status_code=200 if ":5001/" in url else 503)
+
+    client = MagicMock()
+    client.get = AsyncMock(side_effect=fake_get)
+
+    with patch.object(proxy, "vllm_backend_ports", [5001, 5002]), \
+         patch.object(proxy, "vllm_healthy", {5001: False, 5002: True}), \
+         patch.object(proxy, "vllm_live", [5002]), \
+         patch.object(proxy, "vllm_base_urls", {5001: "http://127.0.0.1:5001", 5002: "http://127.0.0.1:5002"}), \
+         patch.object(proxy, "vllm_client", client), \
+         patch.object(proxy.asyncio, "sleep", AsyncMock(side_effect=asyncio.CancelledError)):
+        with pytest.raises(asyncio.CancelledError):
+            await proxy._health_check_vllm()
+
+        assert client.get.await_count == 2
+        assert proxy.vllm_healthy == {5001: True, 5002: False}
+        assert proxy.vllm_live == [5001]
+
+
+def test_any_vllm_healthy():
+    """Test that health is reported from the proxy's last check."""
+    from api import proxy
+
+    with patch.object(proxy, "vllm_live", []):
+        assert not proxy.any_vllm_healthy()
+    with patch.object(proxy, "vllm_live", [5001]):
+        assert proxy.any_vllm_healthy()
+
+
+@pytest.mark.asyncio
+async def test_health_check_backs_off_down_backend():
+    """Test that a backend that went down is probed less and less often."""
+    from api import proxy
+
+    client = MagicMock()
+    client.get = AsyncMock(return_value=MagicMock(status_code=503))
+    clock = MagicMock(return_value=100.0)
+
+    with patch.object(proxy, "vllm_backend_ports", [5001]), \
+         patch.object(proxy, "vllm_healthy", {5001: True}), \
+         patch.object(proxy, "vllm_live", [5001]), \
+         patch.object(proxy, "vllm_failures", {}), \
+         patch.object(proxy, "vllm_next_probe", {}), \
+         patch.object(proxy, "vllm_base_urls", {5001: "http://127.0.0.1:5001"}), \
+         patch.object(proxy, "vllm_client", client), \
+         patch.object(proxy, "time", MagicMock(monotonic=clock)), \
+         patch.object(proxy.asyncio, "sleep", AsyncMock(side_effect=asyncio.CancelledError)):
+        for now, expected_next in ((100.0, 105.0), (105.0, 115.0), (115.0, 135.0)):
+            clock.return_value = now
+            with pytest.raises(asyncio.CancelledError):
+                await proxy._health_check_vllm(interval=5.0)
+            assert proxy.vllm_next_probe[5001] == expected_next
+
+        # Not due yet: no probe is sent
+        clock.return_value = 120.0
+        with pytest.raises(asyncio.CancelledError):
+            await proxy._health_check_vllm(interval=5.0)
+        assert client.get.await_count == 3
+
+        # Recovery resets the backoff
+        client.get.return_value = MagicMock(status_code=200)
+        clock.return_value = 135.0
+        with pytest.raises(asyncio.CancelledError):
+            await proxy._health_check_vllm(interval=5.0)
+        assert 5001 not in proxy.vllm_failures
+        assert proxy.vllm_live == [5001]
+
+
+def test_proxy_chunk_size_depends_on_content_type(fake_vllm, proxy_client):
+    """Test that SSE is passed through as received and other bodies are re-chunked."""
+    from api import proxy
+
+    upstream = fake_vllm.stream.return_value.upstream
+    proxy_client.get("/v1/models")
+    assert upstream.chunk_size == proxy.STREAM_CHUNK_SIZE
+
+    upstream.headers = httpx.Headers({"content-type": "text/event-stream; charset=utf-8"})
+    proxy_client.post("/v1/completions", json={"stream": True})
+    assert upstream.chunk_size is None
@@ -31,6 +31,7 @@ class MockRequest:
     def __init__(self, path: str):
         self.app = MockApp()
         self.url = MockURL(path)
+        self.scope = {"path": path}
 
 @pytest.mark.parametrize(
     "path,pow_running,inf_running,train_running,expected_state",
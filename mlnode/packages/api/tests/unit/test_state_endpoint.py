@@ -0,0 +1,26 @@
+import json
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from unittest.mock import patch
+
+from api.routes import router
+from api.service_management import ServiceState, API_PREFIX
+
+@pytest.fixture
+def app():
+    app = FastAPI()
+    app.include_router(router, prefix=API_PREFIX)
+    return app
+
+@pytest.mark.parametrize("state", list(ServiceState))
+def test_state_endpoint_body(app, state):
+    app.state.service_state = state
+
+    with patch("api.routes.update_service_state"):
+        response = TestClient(app).get("/api/v1/state")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/json"
+    assert json.loads(response.content) == {"state": state.value}
@@ -0,0 +1,42 @@
+import pytest
+from unittest.mock import MagicMock, patch
+
+from api.inference.vllm.runner import VLLMRunner
+
+def make_process(returncode=None):
+    process = MagicMock()
+    process.poll.return_value = returncode
+    return process
+
+@pytest.fixture
+def runner():
+    runner = VLLMRunner(model="test-model")
+    runner.processes = [make_process()]
+    return runner
+
+def test_is_alive_false_when_processes_exited(runner):
+    runner.processes = [make_process(returncode=1)]
+
+    with patch("api.inference.vllm.runner.any_vllm_healthy", return_value=True), \
+         patch("api.inference.vllm.runner.requests.get") as mock_get:
+        assert runner.is_alive() is False
+
+    mock_get.assert_not_called()
+
+def test_is_alive_uses_proxy_health(runner):
+    with patch("api.inference.vllm.runner.any_vllm_healthy", return_value=True), \
+         patch("api.inference.vllm.runner.requests.get") as mock_get:
+        assert runner.is_alive() is True
+
+    mock_get.assert_not_called()
+
+@pytest.mark.parametrize("status_code,expected", [(200, True), (503, False)])
+def test_is_alive_falls_back_to_is_available(runner, status_code, expected):
+    with patch("api.inference.vllm.runner.any_vllm_healthy", return_value=False), \
+         patch("api.inference.vllm.runner.requests.get") as mock_get:
+        mock_get.return_value.status_code = status_code
+        assert runner.is_alive() is expected
+
+    mock_get.assert_called_once_with(
+        f"http://{VLLMRunner.VLLM_HOST}:{VLLMRunner.VLLM_PORT + 1}/health", timeout=2
+    )